@@ -0,0 +1,44 @@
+from typing import NamedTuple
+
+
+class OperationSpan(NamedTuple):
+    operation_id: str
+    # Slice [start, end) of the merged id list this operation contributed
+    start: int
+    end: int
+    # Number of ids the operation asked for, duplicates included
+    total: int
+
+
+def merge_company_ids(operations: list[dict]) -> tuple[list[int], list[OperationSpan]]:
+    """Union the company ids of several add operations, in order, without duplicates.
+
+    Each operation gets the span of the merged list it contributed. Ids already
+    contributed by an earlier operation are not repeated, so a later span only
+    ends once every id that operation asked for has been inserted.
+    """
+    company_ids = []
+    seen = set()
+    spans = []
+    for operation in operations:
+        start = len(company_ids)
+        for company_id in operation["company_ids"]:
+            if company_id not in seen:
+                seen.add(company_id)
+                company_ids.append(company_id)
+        spans.append(
+            OperationSpan(
+                operation["operation_id"],
+                start,
+                len(company_ids),
+                len(operation["company_ids"]),
+            )
+        )
+    return company_ids, spans
+
+
+def span_progress(span: OperationSpan, done: int) -> tuple[int, bool]:
+    """Progress of one operation once the first `done` merged ids are inserted, and whether it is complete"""
+    if done >= span.end:
+        return span.total, True
+    return max(done - span.start, 0), False
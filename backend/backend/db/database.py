@@ -4,6 +4,8 @@ import uuid
 from datetime import datetime
 from typing import Union
 
+import redis
+import redis.asyncio
 from sqlalchemy import (
     Column,
     DateTime,
@@ -25,6 +27,12 @@ engine = create_engine(
 )
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+REDIS_URL = os.getenv('REDIS_URL')
+
+# Sync client for the background worker threads, async client for request handlers
+redis_client = redis.Redis.from_url(REDIS_URL, decode_responses=True)
+async_redis_client = redis.asyncio.Redis.from_url(REDIS_URL, decode_responses=True)
+
 def get_db():
     db = SessionLocal()
     try:
@@ -1,18 +1,26 @@
+import logging
+import random
+import time
 import uuid
 import asyncio
 from typing import Optional
 
-from fastapi import APIRouter, Depends, Query, HTTPException, BackgroundTasks
+from fastapi import APIRouter, Depends, Query, HTTPException
 from pydantic import BaseModel
-from sqlalchemy import func, and_
+from sqlalchemy import func, and_, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import IntegrityError, OperationalError
 from sqlalchemy.orm import Session
 
+from backend.coalescing import merge_company_ids, span_progress
 from backend.db import database
 from backend.routes.companies import (
     CompanyBatchOutput,
     fetch_companies_with_liked,
 )
 
+logger = logging.getLogger(__name__)
+
 router = APIRouter(
     prefix="/collections",
     tags=["collections"],
@@ -45,8 +53,155 @@ class AddCompaniesResponse(BaseModel):
     message: str
 
 
-# In-memory store for operation status tracking
-operations_store = {}
+# Operation status is kept in Redis hashes at op:{operation_id} so that every
+# API worker can report it. The work queue itself is in-process: operations
+# still queued or running at shutdown are marked failed, not resumed.
+# Finished operations are kept for an hour. Live ones may wait in the queue or
+# sit inside one long statement for hours, so they only get a week-long TTL to
+# clean up after a crash, set at creation and never refreshed.
+OPERATION_TTL_SECONDS = 3600
+LIVE_OPERATION_TTL_SECONDS = 7 * 24 * 3600
+FINISHED_STATUSES = ("completed", "failed")
+
+# Process-wide cache of collection names, keyed by collection id
+_collection_name_cache: dict[uuid.UUID, str] = {}
+
+# Queue of pending work, drained by a fixed pool of workers so the number of
+# sessions held by background inserts stays bounded
+_operation_queue: Optional[asyncio.Queue] = None
+OPERATION_WORKER_COUNT = 4
+# Add operations waiting to be coalesced, keyed by target collection. Each
+# bucket is a single queue item; adds for the same target join it until a
+# worker claims it once the coalescing window has passed.
+_pending_adds: dict[uuid.UUID, list[dict]] = {}
+# Operations currently being run by a worker thread
+_running_operation_ids: set[str] = set()
+COALESCE_WINDOW_SECONDS = 0.05
+
+# Number of association rows sent per INSERT statement
+BULK_INSERT_CHUNK_SIZE = 1000
+# Attempts per chunk before a transient error (deadlock, dropped connection) fails the operation
+CHUNK_INSERT_ATTEMPTS = 3
+# Base delay before retrying a chunk, doubled per attempt and jittered so that
+# workers that deadlocked on each other don't collide again straight away
+CHUNK_RETRY_BACKOFF_SECONDS = 0.1
+
+
+def _operation_key(operation_id: str) -> str:
+    return f"op:{operation_id}"
+
+
+async def create_operation(operation_id: str, total: int):
+    key = _operation_key(operation_id)
+    async with database.async_redis_client.pipeline(transaction=True) as pipe:
+        await (
+            pipe.hset(key, mapping={"status": "pending", "progress": 0, "total": total})
+            .expire(key, LIVE_OPERATION_TTL_SECONDS)
+            .execute()
+        )
+
+
+def update_operation(operation_id: str, **fields):
+    """Update an operation's status fields; called from the worker threads"""
+    key = _operation_key(operation_id)
+    with database.redis_client.pipeline(transaction=True) as pipe:
+        pipe.hset(key, mapping=fields)
+        if fields.get("status") in FINISHED_STATUSES:
+            pipe.expire(key, OPERATION_TTL_SECONDS)
+        else:
+            # Only applies if the hash has no TTL, i.e. this write recreated it
+            pipe.expire(key, LIVE_OPERATION_TTL_SECONDS, nx=True)
+        pipe.execute()
+
+
+# Marks each operation failed unless it already completed, atomically per call
+_FAIL_UNLESS_COMPLETED = """
+for _, key in ipairs(KEYS) do
+    if redis.call('HGET', key, 'status') ~= 'completed' then
+        redis.call('HSET', key, 'status', 'failed', 'error_message', ARGV[1])
+        redis.call('EXPIRE', key, ARGV[2])
+    end
+end
+"""
+
+
+async def fail_operations(operation_ids: list[str], error_message: str):
+    """Best-effort: mark operations failed without letting a Redis error propagate.
+
+    Operations that already completed keep their status; their rows are committed.
+    """
+    if not operation_ids:
+        return
+    try:
+        await database.async_redis_client.eval(
+            _FAIL_UNLESS_COMPLETED,
+            len(operation_ids),
+            *[_operation_key(operation_id) for operation_id in operation_ids],
+            error_message,
+            OPERATION_TTL_SECONDS,
+        )
+    except Exception:
+        logger.exception("Could not mark operations %s as failed", operation_ids)
+
+
+async def get_operation(operation_id: str) -> Optional[dict]:
+    fields = await database.async_redis_client.hgetall(_operation_key(operation_id))
+    if not fields:
+        return None
+
+    return {
+        "operation_id": operation_id,
+        # A progress write can recreate a hash that was lost, without its status
+        "status": fields.get("status", "in_progress"),
+        "progress": int(fields["progress"]) if "progress" in fields else None,
+        "total": int(fields["total"]) if "total" in fields else None,
+        "error_message": fields.get("error_message"),
+    }
+
+
+def get_collection_name(db: Session, collection_id: uuid.UUID) -> Optional[str]:
+    """Look up a collection's name, or None if it does not exist"""
+    name = _collection_name_cache.get(collection_id)
+    if name is None:
+        name = (
+            db.query(database.CompanyCollection.collection_name)
+            .filter_by(id=collection_id)
+            .scalar()
+        )
+        if name is not None:
+            _collection_name_cache[collection_id] = name
+    return name
+
+
+def count_collection_companies(db: Session, collection_id: uuid.UUID) -> int:
+    return (
+        db.query(func.count())
+        .select_from(database.CompanyCollectionAssociation)
+        .filter(database.CompanyCollectionAssociation.collection_id == collection_id)
+        .scalar()
+    )
+
+
+def get_collection_names(
+    db: Session, collection_ids: list[uuid.UUID]
+) -> dict[uuid.UUID, str]:
+    """Look up several collections' names in one round-trip; missing collections are omitted"""
+    names = {
+        collection_id: _collection_name_cache[collection_id]
+        for collection_id in collection_ids
+        if collection_id in _collection_name_cache
+    }
+    missing = [collection_id for collection_id in collection_ids if collection_id not in names]
+    if missing:
+        rows = (
+            db.query(database.CompanyCollection.id, database.CompanyCollection.collection_name)
+            .filter(database.CompanyCollection.id.in_(missing))
+            .all()
+        )
+        for collection_id, name in rows:
+            _collection_name_cache[collection_id] = name
+            names[collection_id] = name
+    return names
 
 
 @router.get("", response_model=list[CompanyCollectionMetadata])
@@ -54,6 +209,9 @@ def get_all_collection_metadata(
     db: Session = Depends(database.get_db),
 ):
     collections = db.query(database.CompanyCollection).all()
+    _collection_name_cache.update(
+        {collection.id: collection.collection_name for collection in collections}
+    )
 
     return [
         CompanyCollectionMetadata(
@@ -70,81 +228,277 @@ def get_company_collection_by_id(
     offset: int = Query(
         0, description="The number of items to skip from the beginning"
     ),
-    limit: int = Query(10, description="The number of items to fetch"),
+    limit: int = Query(10, le=200, description="The number of items to fetch"),
+    after_id: Optional[int] = Query(
+        None,
+        description="Return companies with an id greater than this one (keyset pagination, overrides offset)",
+    ),
     db: Session = Depends(database.get_db),
 ):
+    if after_id is not None:
+        # Seek past the last seen id via the primary key instead of scanning skipped
+        # rows. No window total here: count(*) OVER () would have to visit every
+        # remaining row before LIMIT applies.
+        query = db.query(database.Company.id).filter(database.Company.id > after_id)
+    else:
+        # Without a keyset filter, the page carries the collection size in the same round-trip
+        query = db.query(database.Company.id, func.count().over().label("total"))
+
     query = (
-        db.query(database.CompanyCollectionAssociation, database.Company)
-        .join(database.Company)
+        query.join(
+            database.CompanyCollectionAssociation,
+            database.CompanyCollectionAssociation.company_id == database.Company.id,
+        )
         .filter(database.CompanyCollectionAssociation.collection_id == collection_id)
+        .order_by(database.Company.id)
     )
+    if after_id is None:
+        query = query.offset(offset)
 
-    total_count = query.with_entities(func.count()).scalar()
+    results = query.limit(limit).all()
 
-    results = query.order_by(database.Company.id).offset(offset).limit(limit).all()
-    companies = fetch_companies_with_liked(db, [company.id for _, company in results])
+    if after_id is None and results:
+        total_count = results[0].total
+    else:
+        # Keyset pages and empty pages (e.g. past the end) carry no window total
+        total_count = count_collection_companies(db, collection_id)
+
+    companies = fetch_companies_with_liked(db, [row.id for row in results])
 
     return CompanyCollectionOutput(
         id=collection_id,
-        collection_name=db.query(database.CompanyCollection)
-        .get(collection_id)
-        .collection_name,
+        collection_name=get_collection_name(db, collection_id),
         companies=companies,
         total=total_count,
     )
 
 
-async def add_companies_to_collection_task(
+def relax_commit_durability(db: Session):
+    """Let the current transaction commit without waiting for its WAL flush.
+
+    SET LOCAL only lasts until the transaction ends, so this must be issued at
+    the start of every bulk transaction. A crash may lose the last few commits,
+    but never corrupts data; an interrupted operation can simply be re-run.
+    """
+    db.execute(text("SET LOCAL synchronous_commit = OFF"))
+
+
+def insert_associations_chunk(db: Session, chunk: list[dict]):
+    """Insert and commit one chunk of associations, retrying the chunk on transient failures"""
+    for attempt in range(CHUNK_INSERT_ATTEMPTS):
+        try:
+            relax_commit_durability(db)
+            # executemany with a single cached statement; SQLAlchemy's insertmanyvalues
+            # packs the rows into multi-row VALUES batches (1000 rows by default, which
+            # matches BULK_INSERT_CHUNK_SIZE, so each chunk goes out as one statement)
+            db.execute(
+                pg_insert(database.CompanyCollectionAssociation.__table__)
+                .on_conflict_do_nothing(index_elements=["company_id", "collection_id"]),
+                chunk,
+            )
+            db.commit()
+            return
+        except OperationalError:
+            db.rollback()
+            if attempt == CHUNK_INSERT_ATTEMPTS - 1:
+                raise
+            # Runs on a worker thread, so blocking here doesn't stall the event loop
+            time.sleep(random.uniform(0, CHUNK_RETRY_BACKOFF_SECONDS * 2 ** (attempt + 1)))
+
+
+def add_companies_to_collection_task(
+    operations: list[dict],
+    target_collection_id: uuid.UUID,
+    db: Session
+):
+    """Background task to add companies from one or more coalesced operations to a collection"""
+    company_ids, spans = merge_company_ids(operations)
+    completed = set()
+
+    def report_progress(done: int):
+        for span in spans:
+            if span.operation_id in completed:
+                continue
+            progress, is_complete = span_progress(span, done)
+            if is_complete:
+                update_operation(span.operation_id, progress=progress, status="completed")
+                completed.add(span.operation_id)
+            elif progress:
+                update_operation(span.operation_id, progress=progress)
+
+    try:
+        # total is recorded from len(company_ids) when each operation is created;
+        # duplicates are resolved by uq_company_collection at insert time
+        for span in spans:
+            update_operation(span.operation_id, status="in_progress")
+
+        values = [
+            {"company_id": company_id, "collection_id": target_collection_id}
+            for company_id in company_ids
+        ]
+
+        # Insert in chunks, letting the unique constraint skip duplicates
+        for start in range(0, len(values), BULK_INSERT_CHUNK_SIZE):
+            chunk = values[start:start + BULK_INSERT_CHUNK_SIZE]
+            insert_associations_chunk(db, chunk)
+
+            report_progress(start + len(chunk))
+
+        # Operations that contributed no new ids complete here
+        report_progress(len(company_ids))
+
+    except Exception as e:
+        if isinstance(e, IntegrityError) and len(operations) > 1:
+            db.rollback()
+            # Retry each unfinished operation alone, so one bad id (e.g. a company
+            # deleted after validation) only fails the operation that asked for it
+            for operation in operations:
+                if operation["operation_id"] not in completed:
+                    add_companies_to_collection_task([operation], target_collection_id, db)
+            return
+
+        # Record failures before rolling back: the rollback itself can raise on a
+        # dead connection, and completed operations must not be reported failed
+        for span in spans:
+            if span.operation_id not in completed:
+                update_operation(span.operation_id, status="failed", error_message=str(e))
+        db.rollback()
+
+
+def add_all_companies_to_collection_task(
     operation_id: str,
-    company_ids: list[int],
+    total: int,
     source_collection_id: uuid.UUID,
     target_collection_id: uuid.UUID,
     db: Session
 ):
-    """Background task to add companies to collection with progress tracking"""
+    """Background task to copy every company of a collection into another, entirely in SQL"""
     try:
-        operations_store[operation_id]["status"] = "in_progress"
-        operations_store[operation_id]["total"] = len(company_ids)
-        
-        # Filter out companies that are already in the target collection
-        existing_associations = db.query(database.CompanyCollectionAssociation).filter(
-            and_(
-                database.CompanyCollectionAssociation.company_id.in_(company_ids),
-                database.CompanyCollectionAssociation.collection_id == target_collection_id
-            )
-        ).all()
-        
-        existing_company_ids = {assoc.company_id for assoc in existing_associations}
-        companies_to_add = [cid for cid in company_ids if cid not in existing_company_ids]
-        
-        operations_store[operation_id]["total"] = len(companies_to_add)
-        
-        # Add companies one by one to trigger the throttling mechanism
-        for i, company_id in enumerate(companies_to_add):
-            try:
-                association = database.CompanyCollectionAssociation(
-                    company_id=company_id,
-                    collection_id=target_collection_id
-                )
-                db.add(association)
-                db.commit()
-                
-                operations_store[operation_id]["progress"] = i + 1
-                
-            except Exception as e:
-                db.rollback()
-                # Skip duplicates but continue with others
-                if "uq_company_collection" not in str(e):
-                    raise e
-        
-        operations_store[operation_id]["status"] = "completed"
-        
+        update_operation(operation_id, status="in_progress")
+
+        relax_commit_durability(db)
+        db.execute(
+            text("""
+    INSERT INTO company_collection_associations (company_id, collection_id)
+    SELECT company_id, :target_collection_id
+    FROM company_collection_associations
+    WHERE collection_id = :source_collection_id
+    ON CONFLICT DO NOTHING
+    """),
+            {
+                "source_collection_id": source_collection_id,
+                "target_collection_id": target_collection_id,
+            },
+        )
+        db.commit()
+
+        update_operation(operation_id, progress=total, status="completed")
+
     except Exception as e:
-        operations_store[operation_id]["status"] = "failed"
-        operations_store[operation_id]["error_message"] = str(e)
+        update_operation(operation_id, status="failed", error_message=str(e))
         db.rollback()
-    finally:
-        db.close()
+
+
+def run_add_operations(operations: list[dict], target_collection_id: uuid.UUID):
+    with database.SessionLocal() as db:
+        add_companies_to_collection_task(operations, target_collection_id, db)
+
+
+def run_add_all_operation(operation: dict):
+    with database.SessionLocal() as db:
+        add_all_companies_to_collection_task(
+            operation["operation_id"],
+            operation["total"],
+            operation["source_collection_id"],
+            operation["target_collection_id"],
+            db,
+        )
+
+
+async def enqueue_add_operation(operation: dict):
+    """Queue an add operation, joining a pending bucket for the same target if there is one"""
+    target_collection_id = operation["target_collection_id"]
+    bucket = _pending_adds.get(target_collection_id)
+    if bucket is not None:
+        bucket.append(operation)
+        return
+
+    _pending_adds[target_collection_id] = [operation]
+    await _operation_queue.put({
+        "type": "add",
+        "target_collection_id": target_collection_id,
+        "queued_at": asyncio.get_running_loop().time(),
+    })
+
+
+async def operation_worker(queue: asyncio.Queue):
+    loop = asyncio.get_running_loop()
+    while True:
+        item = await queue.get()
+        operations = [item] if item["type"] != "add" else []
+        try:
+            if item["type"] == "add":
+                # Give other adds for this target until the end of the window to
+                # join the bucket, so they share a single bulk insert
+                await asyncio.sleep(
+                    max(item["queued_at"] + COALESCE_WINDOW_SECONDS - loop.time(), 0)
+                )
+                operations = _pending_adds.pop(item["target_collection_id"])
+                _running_operation_ids.update(
+                    operation["operation_id"] for operation in operations
+                )
+
+                # The inserts are blocking, so keep them off the event loop
+                await asyncio.to_thread(
+                    run_add_operations, operations, item["target_collection_id"]
+                )
+            else:
+                _running_operation_ids.add(item["operation_id"])
+                await asyncio.to_thread(run_add_all_operation, item)
+        except Exception as e:
+            # The tasks record their own failures; this only catches errors that
+            # escape them (e.g. Redis down, rollback on a dead connection). Keep
+            # the worker alive so the pool doesn't shrink.
+            logger.exception("Operation worker failed while running %s", item)
+            await fail_operations(
+                [operation["operation_id"] for operation in operations], str(e)
+            )
+        finally:
+            _running_operation_ids.difference_update(
+                operation["operation_id"] for operation in operations
+            )
+            queue.task_done()
+
+
+def start_operation_workers() -> list[asyncio.Task]:
+    """Create the operation queue and spawn its workers; call from the app lifespan"""
+    global _operation_queue
+    _operation_queue = asyncio.Queue()
+    return [
+        asyncio.create_task(operation_worker(_operation_queue))
+        for _ in range(OPERATION_WORKER_COUNT)
+    ]
+
+
+async def stop_operation_workers(workers: list[asyncio.Task]):
+    """Stop the workers and fail every operation that won't finish in this process"""
+    # Cancelling a worker doesn't stop its thread, which may still record
+    # completion later; until then the operation reads as failed, not in_progress
+    interrupted = list(_running_operation_ids)
+    for worker in workers:
+        worker.cancel()
+    await asyncio.gather(*workers, return_exceptions=True)
+
+    while not _operation_queue.empty():
+        item = _operation_queue.get_nowait()
+        if item["type"] != "add":
+            interrupted.append(item["operation_id"])
+    for operations in _pending_adds.values():
+        interrupted.extend(operation["operation_id"] for operation in operations)
+    _pending_adds.clear()
+
+    if interrupted:
+        await fail_operations(interrupted, "Server shut down before the operation finished")
 
 
 @router.post("/{source_collection_id}/add-to/{target_collection_id}", response_model=AddCompaniesResponse)
@@ -152,55 +506,44 @@ async def add_companies_to_collection(
     source_collection_id: uuid.UUID,
     target_collection_id: uuid.UUID,
     request: AddCompaniesRequest,
-    background_tasks: BackgroundTasks,
     db: Session = Depends(database.get_db)
 ):
     """Add selected companies from source collection to target collection"""
     
     # Validate collections exist
-    source_collection = db.query(database.CompanyCollection).get(source_collection_id)
-    target_collection = db.query(database.CompanyCollection).get(target_collection_id)
+    names = get_collection_names(db, [source_collection_id, target_collection_id])
     
-    if not source_collection or not target_collection:
+    if source_collection_id not in names or target_collection_id not in names:
         raise HTTPException(status_code=404, detail="Collection not found")
     
     # Validate that companies exist in source collection
-    valid_company_ids = set()
     if request.company_ids:
-        existing_in_source = db.query(database.CompanyCollectionAssociation).filter(
+        found_count = db.query(func.count()).select_from(
+            database.CompanyCollectionAssociation
+        ).filter(
             and_(
                 database.CompanyCollectionAssociation.company_id.in_(request.company_ids),
                 database.CompanyCollectionAssociation.collection_id == source_collection_id
             )
-        ).all()
-        valid_company_ids = {assoc.company_id for assoc in existing_in_source}
+        ).scalar()
         
-        if len(valid_company_ids) != len(request.company_ids):
+        if found_count != len(request.company_ids):
             raise HTTPException(status_code=400, detail="Some companies not found in source collection")
     
     operation_id = str(uuid.uuid4())
-    operations_store[operation_id] = {
-        "operation_id": operation_id,
-        "status": "pending",
-        "progress": 0,
-        "total": len(request.company_ids),
-        "error_message": None
-    }
+    await create_operation(operation_id, len(request.company_ids))
     
-    # Create a new database session for the background task
-    background_db = database.SessionLocal()
-    background_tasks.add_task(
-        add_companies_to_collection_task,
-        operation_id,
-        request.company_ids,
-        source_collection_id,
-        target_collection_id,
-        background_db
-    )
+    await enqueue_add_operation({
+        "type": "add",
+        "operation_id": operation_id,
+        "company_ids": request.company_ids,
+        "source_collection_id": source_collection_id,
+        "target_collection_id": target_collection_id,
+    })
     
     return AddCompaniesResponse(
         operation_id=operation_id,
-        message=f"Adding {len(request.company_ids)} companies to {target_collection.collection_name}"
+        message=f"Adding {len(request.company_ids)} companies to {names[target_collection_id]}"
     )
 
 
@@ -208,55 +551,41 @@ async def add_companies_to_collection(
 async def add_all_companies_to_collection(
     source_collection_id: uuid.UUID,
     target_collection_id: uuid.UUID,
-    background_tasks: BackgroundTasks,
     db: Session = Depends(database.get_db)
 ):
     """Add all companies from source collection to target collection"""
     
     # Validate collections exist
-    source_collection = db.query(database.CompanyCollection).get(source_collection_id)
-    target_collection = db.query(database.CompanyCollection).get(target_collection_id)
+    names = get_collection_names(db, [source_collection_id, target_collection_id])
     
-    if not source_collection or not target_collection:
+    if source_collection_id not in names or target_collection_id not in names:
         raise HTTPException(status_code=404, detail="Collection not found")
     
-    # Get all company IDs from source collection
-    source_companies = db.query(database.CompanyCollectionAssociation).filter(
-        database.CompanyCollectionAssociation.collection_id == source_collection_id
-    ).all()
-    
-    company_ids = [assoc.company_id for assoc in source_companies]
+    # Count the source companies; the copy itself happens server-side
+    total = count_collection_companies(db, source_collection_id)
     
     operation_id = str(uuid.uuid4())
-    operations_store[operation_id] = {
-        "operation_id": operation_id,
-        "status": "pending",
-        "progress": 0,
-        "total": len(company_ids),
-        "error_message": None
-    }
+    await create_operation(operation_id, total)
     
-    # Create a new database session for the background task
-    background_db = database.SessionLocal()
-    background_tasks.add_task(
-        add_companies_to_collection_task,
-        operation_id,
-        company_ids,
-        source_collection_id,
-        target_collection_id,
-        background_db
-    )
+    await _operation_queue.put({
+        "type": "add_all",
+        "operation_id": operation_id,
+        "total": total,
+        "source_collection_id": source_collection_id,
+        "target_collection_id": target_collection_id,
+    })
     
     return AddCompaniesResponse(
         operation_id=operation_id,
-        message=f"Adding all {len(company_ids)} companies from {source_collection.collection_name} to {target_collection.collection_name}"
+        message=f"Adding all {total} companies from {names[source_collection_id]} to {names[target_collection_id]}"
     )
 
 
 @router.get("/operations/{operation_id}", response_model=OperationStatus)
-def get_operation_status(operation_id: str):
+async def get_operation_status(operation_id: str):
     """Get the status of a background operation"""
-    if operation_id not in operations_store:
+    operation = await get_operation(operation_id)
+    if operation is None:
         raise HTTPException(status_code=404, detail="Operation not found")
     
-    return OperationStatus(**operations_store[operation_id])
+    return OperationStatus(**operation)
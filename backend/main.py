@@ -22,7 +22,10 @@ async def lifespan(app: FastAPI):
         db.add(database.Settings(setting_name="seeded"))
         db.commit()
         db.close()
+
+    workers = collections.start_operation_workers()
     yield
+    await collections.stop_operation_workers(workers)
     # Clean up...
 
 
@@ -0,0 +1,66 @@
+import unittest
+
+from backend.coalescing import OperationSpan, merge_company_ids, span_progress
+
+
+def add_operation(operation_id, company_ids):
+    return {"type": "add", "operation_id": operation_id, "company_ids": company_ids}
+
+
+class MergeCompanyIdsTest(unittest.TestCase):
+    def test_spans_follow_operation_order(self):
+        company_ids, spans = merge_company_ids(
+            [add_operation("a", [1, 2]), add_operation("b", [3, 4, 5])]
+        )
+
+        self.assertEqual(company_ids, [1, 2, 3, 4, 5])
+        self.assertEqual(
+            spans, [OperationSpan("a", 0, 2, 2), OperationSpan("b", 2, 5, 3)]
+        )
+
+    def test_shared_ids_are_only_inserted_once(self):
+        company_ids, spans = merge_company_ids(
+            [add_operation("a", [1, 2]), add_operation("b", [2, 3])]
+        )
+
+        self.assertEqual(company_ids, [1, 2, 3])
+        self.assertEqual(
+            spans, [OperationSpan("a", 0, 2, 2), OperationSpan("b", 2, 3, 2)]
+        )
+
+    def test_duplicates_within_an_operation_count_towards_its_total(self):
+        company_ids, spans = merge_company_ids([add_operation("a", [1, 1, 2])])
+
+        self.assertEqual(company_ids, [1, 2])
+        self.assertEqual(spans, [OperationSpan("a", 0, 2, 3)])
+
+    def test_operation_covered_by_earlier_ones_has_an_empty_span(self):
+        _, spans = merge_company_ids(
+            [add_operation("a", [1, 2]), add_operation("b", [2, 1]), add_operation("c", [])]
+        )
+
+        self.assertEqual(spans[1], OperationSpan("b", 2, 2, 2))
+        self.assertEqual(spans[2], OperationSpan("c", 2, 2, 0))
+
+
+class SpanProgressTest(unittest.TestCase):
+    def test_not_started(self):
+        self.assertEqual(span_progress(OperationSpan("b", 2, 5, 3), 2), (0, False))
+        self.assertEqual(span_progress(OperationSpan("b", 2, 5, 3), 0), (0, False))
+
+    def test_partially_inserted(self):
+        self.assertEqual(span_progress(OperationSpan("b", 2, 5, 3), 4), (2, False))
+
+    def test_complete_reports_requested_total(self):
+        self.assertEqual(span_progress(OperationSpan("a", 0, 2, 3), 2), (3, True))
+        self.assertEqual(span_progress(OperationSpan("a", 0, 2, 3), 5), (3, True))
+
+    def test_empty_span_completes_with_the_ids_before_it(self):
+        span = OperationSpan("b", 2, 2, 2)
+
+        self.assertEqual(span_progress(span, 1), (0, False))
+        self.assertEqual(span_progress(span, 2), (2, True))
+
+
+if __name__ == "__main__":
+    unittest.main()